@@ -1,5 +1,9 @@
 import numpy as np
+import pandas as pd
 from datetime import datetime # 导入 datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import toml
 import hdbscan
 from pathlib import Path
@@ -31,6 +35,25 @@ DATASET_ID = bq_config['dataset_id']
 TASK_STATUS_TABLE = bq_config['task_status_table_name']
 
 # --- 函数定义 ---
+def fit_clusters(df_valid, task_id):
+    """对有效的嵌入向量运行 HDBSCAN，返回待上传的聚类结果"""
+    embeddings_matrix = np.stack(df_valid['issue_embedding'].to_numpy())
+
+    # 应用 HDBSCAN
+    print(f"Applying HDBSCAN with min_samples={HDBDSCAN_MIN_SAMPLES}...")
+    clusterer = hdbscan.HDBSCAN(min_samples=HDBDSCAN_MIN_SAMPLES)
+    clusters = clusterer.fit_predict(embeddings_matrix)
+
+    # 准备上传的数据
+    df_to_upload = df_valid[['ticket_id']].copy()
+    df_to_upload['cluster_id'] = clusters
+
+    # 为 cluster_id 添加UUID后缀，确保每次运行的簇ID唯一
+    uuid_str = task_id
+    df_to_upload['cluster_id'] = df_to_upload['cluster_id'].astype(str) + "|" + uuid_str
+    df_to_upload['id'] = uuid_str
+    return df_to_upload
+
 def cluster_issues(business, startDate, endDate, lang, task_id):
     print(f"--- Processing clusters for date range: {startDate} to {endDate} ---")
     embedding_table_id = f"{PROJECT_ID}.{DATASET_ID}.{bq_config['embedding_table_name']}"
@@ -52,21 +75,7 @@ def cluster_issues(business, startDate, endDate, lang, task_id):
     if df_valid.empty:
         print(f"No valid embeddings after dropping NaNs. Skipping.")
 
-    embeddings_matrix = np.stack(df_valid['issue_embedding'].to_numpy())
-
-    # 应用 HDBSCAN
-    print(f"Applying HDBSCAN with min_samples={HDBDSCAN_MIN_SAMPLES}...")
-    clusterer = hdbscan.HDBSCAN(min_samples=HDBDSCAN_MIN_SAMPLES)
-    clusters = clusterer.fit_predict(embeddings_matrix)
-
-    # 准备上传的数据
-    df_to_upload = df_valid[['ticket_id']].copy()
-    df_to_upload['cluster_id'] = clusters
-
-    # 为 cluster_id 添加UUID后缀，确保每次运行的簇ID唯一
-    uuid_str = task_id
-    df_to_upload['cluster_id'] = df_to_upload['cluster_id'].astype(str) + "|" + uuid_str
-    df_to_upload['id'] = uuid_str
+    df_to_upload = fit_clusters(df_valid, task_id)
 
     print(f"Generated {df_to_upload['cluster_id'].nunique()} unique clusters from {startDate} to {endDate}.")
 
@@ -79,6 +88,19 @@ def cluster_issues(business, startDate, endDate, lang, task_id):
 
     print("--- Finished: Clustering issues ---")
 
+def update_task_status(task_ids, status, error_message=""):
+    """批量更新任务状态"""
+    time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    task_id_list = ", ".join(f"'{task_id}'" for task_id in task_ids)
+    error_message_escaped = str(error_message).replace("'", "\\'")
+    update_status_query = f"""
+        UPDATE `{PROJECT_ID}.{DATASET_ID}.{TASK_STATUS_TABLE}`
+        SET status = '{status}', error_message = '{error_message_escaped}', updated_at = '{time}'
+        WHERE task_id IN ({task_id_list})
+    """
+    bq.execute_sql(update_status_query)
+    print(f"Tasks {task_ids} status updated to '{status}'.")
+
 def run_pipeline(business, startDate, endDate, lang, task_id):
     """主函数，按顺序运行整个数据处理流程"""
     print(f"======== Starting Data Processing Pipeline ========")
@@ -98,31 +120,126 @@ def run_pipeline(business, startDate, endDate, lang, task_id):
             summary_model = bq_config['summary_model'],
             cluster_table = bq_config['cluster_table_name'],
             summary_table = bq_config['summary_table_name'],
-            task_id = task_id,
+            task_ids = f"'{task_id}'",
         )
         bq.execute_sql(sql)
         
         # 更新任务状态为 'success'
-        time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        update_status_query = f"""
-            UPDATE `{PROJECT_ID}.{DATASET_ID}.{TASK_STATUS_TABLE}`
-            SET status = 'success', updated_at = '{time}'
-            WHERE task_id = '{task_id}'
-        """
-        bq.execute_sql(update_status_query)
-        print(f"Task {task_id} status updated to 'success'.")
+        update_task_status([task_id], 'success')
         print(f"======== Pipeline Completed Successfully ========")        
 
     except Exception as e:
         print(f"======== Pipeline Failed: {e} ========")
         # 更新任务状态为 'failed'
-        time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        error_message_escaped = str(e).replace("'", "\\'")
-        update_status_query = f"""
-            UPDATE `{PROJECT_ID}.{DATASET_ID}.{TASK_STATUS_TABLE}`
-            SET status = 'failed', error_message = '{error_message_escaped}', updated_at = '{time}'
-            WHERE task_id = '{task_id}'
-        """
-        bq.execute_sql(update_status_query)
-        print(f"Task {task_id} status updated to 'failed'. Error: {e}")
+        update_task_status([task_id], 'failed', e)
+
+def cluster_segment(job):
+    """在子进程中对单个分段运行聚类，返回 (task_id, 聚类结果, 错误信息)"""
+    task_id, df_segment = job
+    try:
+        return task_id, fit_clusters(df_segment, task_id), None
+    except Exception as e:
+        print(f"Clustering failed for task {task_id}: {e}")
+        return task_id, None, str(e)
+
+def run_batch_pipeline(segments, startDate, endDate):
+    """
+    批量处理多个 (business, lang) 分段：只读取一次嵌入向量，
+    并行聚类各分段，再用一条 SQL 为所有分段生成 FAQ。
+
+    Args:
+        segments (list[dict]): 每项包含 business、lang、task_id。
+        startDate (str): 开始日期，格式 YYYY-MM-DD。
+        endDate (str): 结束日期，格式 YYYY-MM-DD。
+    """
+    print(f"======== Starting Batch Data Processing Pipeline ({len(segments)} segments) ========")
+    pending_task_ids = [segment['task_id'] for segment in segments]
+
+    try:
+        # 一次性读取所有分段的嵌入向量
+        print(f"--- Processing clusters for date range: {startDate} to {endDate} ---")
+        embedding_table_id = f"{PROJECT_ID}.{DATASET_ID}.{bq_config['embedding_table_name']}"
+        segment_conditions = []
+        for segment in segments:
+            if segment['lang'] == "all":
+                segment_conditions.append(f"(business = '{segment['business']}')")
+            else:
+                segment_conditions.append(f"(business = '{segment['business']}' and ticket_language = '{segment['lang']}')")
+        query = f"SELECT ticket_id, business, ticket_language, issue_embedding FROM `{embedding_table_id}` WHERE dt between '{startDate}' and '{endDate}' and ({' OR '.join(segment_conditions)})"
+        print(query)
+        df = bq.read_gbq_to_dataframe(query)
+        df_valid = df.dropna(subset=['issue_embedding'])
+
+        # 按分段切分数据，没有数据的分段直接标记为失败
+        jobs = []
+        for segment in segments:
+            mask = df_valid['business'] == segment['business']
+            if segment['lang'] != "all":
+                mask &= df_valid['ticket_language'] == segment['lang']
+            df_segment = df_valid[mask]
+            if df_segment.empty:
+                print(f"No valid embeddings for {segment['business']}/{segment['lang']}. Skipping.")
+                pending_task_ids.remove(segment['task_id'])
+                update_task_status([segment['task_id']], 'failed', "No valid embeddings found for this segment.")
+                continue
+            jobs.append((segment['task_id'], df_segment[['ticket_id', 'issue_embedding']]))
+
+        if not jobs:
+            print(f"======== Batch Pipeline Completed: no segment had data ========")
+            return
+
+        # 多进程并行聚类
+        print("--- Starting: CLustering tickets ---")
+        processes = min(len(jobs), multiprocessing.cpu_count())
+        results = []
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {executor.submit(cluster_segment, job): job[0] for job in jobs}
+            # 逐个收集结果，子进程被强制终止（如 OOM）时只影响未完成的分段
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except BrokenProcessPool as e:
+                    print(f"Clustering worker crashed for task {futures[future]}: {e}")
+                    results.append((futures[future], None, f"Clustering worker crashed: {e}"))
+
+        cluster_frames = []
+        for task_id, df_to_upload, error in results:
+            if error is not None:
+                pending_task_ids.remove(task_id)
+                update_task_status([task_id], 'failed', error)
+                continue
+            print(f"Task {task_id}: generated {df_to_upload['cluster_id'].nunique()} unique clusters.")
+            cluster_frames.append(df_to_upload)
+
+        if not cluster_frames:
+            print(f"======== Batch Pipeline Completed: all segments failed ========")
+            return
+
+        # 一次上传所有分段的聚类结果
+        bq.upload_dataframe_to_gbq(
+            pd.concat(cluster_frames, ignore_index=True),
+            bq_config['cluster_table_name'],
+            if_exists='append'
+        )
+        print("--- Finished: Clustering issues ---")
 
+        # 用一条 SQL 为所有分段生成 FAQ
+        print("--- Starting: Generating FAQ from clusters ---")
+        sql = get_template("sql/4_generate_faq.sql").format(
+            project_id = PROJECT_ID,
+            dataset_id = DATASET_ID,
+            faq_table = bq_config['faq_table_name'],
+            summary_model = bq_config['summary_model'],
+            cluster_table = bq_config['cluster_table_name'],
+            summary_table = bq_config['summary_table_name'],
+            task_ids = ", ".join(f"'{task_id}'" for task_id in pending_task_ids),
+        )
+        bq.execute_sql(sql)
+
+        update_task_status(pending_task_ids, 'success')
+        print(f"======== Batch Pipeline Completed Successfully ========")
+
+    except Exception as e:
+        print(f"======== Batch Pipeline Failed: {e} ========")
+        if pending_task_ids:
+            update_task_status(pending_task_ids, 'failed', e)
@@ -2,7 +2,8 @@ from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from datetime import date, datetime # 导入 datetime
-from cluster_issue import run_pipeline
+from typing import List
+from cluster_issue import run_pipeline, run_batch_pipeline
 import uuid
 from bq_handler import BigQueryHandler # 导入 BigQueryHandler
 from summary_issue import run_summary_pipeline
@@ -86,6 +87,79 @@ async def run_cluster_issues(request: ClusterRequest):
         "created_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
     }
 
+class ClusterSegment(BaseModel):
+    business: str
+    lang: str
+
+class BatchClusterRequest(BaseModel):
+    segments: List[ClusterSegment]
+    startDate: date
+    endDate: date
+
+@app.post("/cluster_issues/batch")
+async def run_batch_cluster_issues(request: BatchClusterRequest):
+    """
+    批量聚类多个 (business, lang) 分段，共享一次嵌入向量读取和一次 FAQ 生成，每个分段有独立的 task_id。
+    """
+    if request.startDate > request.endDate:
+        raise HTTPException(status_code=400, detail="Invalid parameter format: startDate cannot be after endDate")
+    if not request.segments:
+        raise HTTPException(status_code=400, detail="Invalid parameter format: segments cannot be empty")
+
+    start_date = request.startDate.strftime("%Y-%m-%d")
+    end_date = request.endDate.strftime("%Y-%m-%d")
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    segments = [
+        {"business": segment.business, "lang": segment.lang, "task_id": str(uuid.uuid4())}
+        for segment in request.segments
+    ]
+    # 每个分段一行初始任务状态
+    initial_status_data = [
+        {
+            "task_id": segment["task_id"],
+            "business": segment["business"],
+            "start_date": start_date,
+            "end_date": end_date,
+            "lang": segment["lang"],
+            "status": "running",
+            "created_at": now,
+            "updated_at": now,
+            "error_message": "",
+        }
+        for segment in segments
+    ]
+    import pandas as pd # 导入 pandas
+    df_initial_status = pd.DataFrame(initial_status_data)
+
+    # 一次写入所有分段的初始任务状态到 BigQuery
+    try:
+        bq_handler.upload_dataframe_to_gbq(df_initial_status, task_status_table, if_exists='append')
+        print(f"Batch of {len(segments)} tasks initial status 'running' written to BigQuery.")
+    except Exception as e:
+        print(f"Error writing initial task status to BigQuery: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to record initial task status: {e}")
+
+    # 使用multiprocessing运行批量pipeline
+    cluster_process = multiprocessing.Process(
+        target=run_batch_pipeline,
+        args=(segments, start_date, end_date)
+    )
+    cluster_process.start()
+    print(f"Batch cluster pipeline process started with PID: {cluster_process.pid}")
+
+    return [
+        {
+            "task_id": segment["task_id"],
+            "business": segment["business"],
+            "start_date": start_date,
+            "end_date": end_date,
+            "lang": segment["lang"],
+            "status": "running",
+            "created_at": now,
+        }
+        for segment in segments
+    ]
+
 @app.get("/tasks/{task_id}/faq")
 async def get_task_faq(task_id: str):
     """
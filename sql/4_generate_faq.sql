@@ -30,7 +30,7 @@ AI.GENERATE_TABLE( MODEL `{dataset_id}.{summary_model}`,
     `{project_id}.{dataset_id}.{summary_table}` t2
     ON
     t1.ticket_id = t2.ticket_id
-    WHERE cluster_id NOT LIKE '-1|%' and t1.id = '{task_id}'
+    WHERE cluster_id NOT LIKE '-1|%' and t1.id IN ({task_ids})
     GROUP BY cluster_id, business, t1.id
     ),
     STRUCT("summarized STRING" AS output_schema, 8192 AS max_output_tokens)